@@ -0,0 +1,106 @@
+import json
+import platform
+import sys
+from argparse import ArgumentParser
+from timeit import Timer
+from typing import Any, Dict, List
+
+from periclase.config import load as config_load
+
+from .cases import CASES_VERSION, cases
+
+REPEAT = 5
+
+
+def run(config_path: str, output: str, only: List[str]) -> None:
+    config = config_load(config_path)
+
+    results: Dict[str, Dict[str, Any]] = {}
+    for case in cases(config):
+        if only and not any(o in case.name for o in only):
+            continue
+
+        with case.setup() as func:
+            timer = Timer(func)
+            number, _ = timer.autorange()
+            times = [t / number for t in timer.repeat(REPEAT, number)]
+
+        results[case.name] = {"best": min(times), "number": number}
+        print(f"{case.name:40} {min(times) * 1e6:12.3f}us")
+
+    with open(output, "w") as file:
+        json.dump(
+            {
+                "python": platform.python_version(),
+                "cases_version": CASES_VERSION,
+                "results": results,
+            },
+            file,
+            indent=2,
+            sort_keys=True,
+        )
+
+
+def compare(baseline_path: str, current_path: str, threshold: float) -> bool:
+    with open(baseline_path) as file:
+        baseline_json = json.load(file)
+    with open(current_path) as file:
+        current_json = json.load(file)
+
+    # results from before we recorded this have version 1
+    baseline_version = baseline_json.get("cases_version", 1)
+    current_version = current_json.get("cases_version", 1)
+    if not baseline_version == current_version:
+        print(
+            f"MISMATCH: {baseline_path} is cases_version {baseline_version} but"
+            f" {current_path} is {current_version}; take a new baseline"
+        )
+        return False
+
+    baseline = baseline_json["results"]
+    current = current_json["results"]
+
+    ok = True
+    for name in sorted(baseline.keys() & current.keys()):
+        ratio = current[name]["best"] / baseline[name]["best"]
+        regressed = ratio > 1 + threshold
+        if regressed:
+            ok = False
+
+        mark = "REGRESSED" if regressed else ""
+        print(f"{name:40} {ratio:8.2f}x {mark}")
+
+    # a case that comes and goes is as suspicious as a slow one
+    for name in sorted(baseline.keys() - current.keys()):
+        ok = False
+        print(f"{name:40} MISSING from {current_path}")
+    for name in sorted(current.keys() - baseline.keys()):
+        ok = False
+        print(f"{name:40} MISSING from {baseline_path}")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog="python3 -m benchmarks")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    parser_run = subparsers.add_parser("run")
+    parser_run.add_argument("--config", default="config.example.yaml")
+    parser_run.add_argument("--output", default="bench_output.json")
+    parser_run.add_argument("only", nargs="*")
+
+    parser_compare = subparsers.add_parser("compare")
+    parser_compare.add_argument("baseline")
+    parser_compare.add_argument("current")
+    parser_compare.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="fail when slower than baseline by more than this fraction",
+    )
+
+    args = parser.parse_args()
+    if args.mode == "run":
+        run(args.config, args.output, args.only)
+    elif not compare(args.baseline, args.current, args.threshold):
+        sys.exit(1)
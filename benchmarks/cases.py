@@ -0,0 +1,253 @@
+import asyncio
+import re
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from functools import partial
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Coroutine,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from periclase import RE_VERSION, Bot, Server
+from periclase.config import Config
+from periclase.database.reject import Action, Reject
+from periclase.database.trigger import Trigger, TriggerAction
+from periclase.pool import MatcherPool
+from periclase.utils import PatternCache, compile_pattern, tokenize_pattern
+
+T = TypeVar("T")
+
+# bump whenever an existing case starts measuring something different, so
+# `compare` won't line up results that aren't comparable
+CASES_VERSION = 5
+
+RULE_COUNTS = [10, 100, 1000]
+# connections that arrive together, e.g. after a netsplit, and how many
+# rules to match them against
+BURST = 200
+BURST_RULES = 1000
+# 0 for matching in-process
+POOL_SIZES = [0, 1, 2, 4]
+
+
+def _version(ctcp: str) -> str:
+    p_version = RE_VERSION.search(ctcp)
+    assert p_version is not None
+    return p_version.group("version")
+
+
+# inputs that look like what we see on the network
+CTCP_REAL = "\x01VERSION matrix-appservice-irc 0.35.2 bridged via matrix.org\x01"
+NUHR_REAL = "jess!~meow@2001:db8:1:2::3 a very normal realname"
+PATTERN_REAL = "/^matrix-appservice-irc 0\\.33\\.1 bridged via /i some reason|oper"
+CLICONN_REAL = (
+    ":irc.example NOTICE * :*** Notice -- Client connecting: jess"
+    " (~meow@2001:db8:1:2::3) [2001:db8:1:2::3] {users} <*> [a very normal realname]"
+)
+
+# inputs that go out of their way to make the primitives do as much as they can
+CTCP_ADVERSE = "\x01VERSION " + "x\x01" * 200
+NUHR_ADVERSE = "a" * 16 + "!" + "b" * 10 + "@" + "c" * 64 + " " + "d " * 25
+# what _check_rejects is actually given; RE_VERSION's `version` group
+VERSION_REAL = _version(CTCP_REAL)
+VERSION_ADVERSE = _version("\x01VERSION product1 " + "9." * 200 + "\x01")
+PATTERN_ADVERSE = "/" + "\\/" * 200 + "/i^$ " + "reason " * 50
+CLICONN_ADVERSE = CLICONN_REAL[:-1] + " ]" * 100
+
+
+# builds what a case needs only once we know it's going to be run, and tears
+# it down afterwards
+Setup = Callable[[], ContextManager[Callable[[], Any]]]
+
+
+@dataclass
+class Case:
+    name: str
+    setup: Setup
+
+
+@contextmanager
+def _ready(func: Callable[[], Any]) -> Iterator[Callable[[], Any]]:
+    yield func
+
+
+def _plain(func: Callable[..., Any], *args: Any) -> Setup:
+    # for cases that need nothing set up
+    return partial(_ready, partial(func, *args))
+
+
+@contextmanager
+def _with_server(
+    server: Callable[[], Server], check: Callable[..., Any], *args: Any
+) -> Iterator[Callable[[], Any]]:
+    yield partial(check, server(), *args)
+
+
+def _run(coro: Coroutine[Any, Any, T]) -> T:
+    # drive a coroutine that never actually suspends, without an event loop
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError("coroutine suspended")
+
+
+def _check_triggers(server: Server, nuhr: str, ip: str) -> Any:
+    return _run(server._check_triggers(nuhr, ip))
+
+
+def _check_rejects(server: Server, version: str) -> Any:
+    return _run(server._check_rejects(version))
+
+
+def _compile_pattern(pattern: str) -> None:
+    # so we measure a compile, not a hit in `re`'s own cache
+    re.purge()
+    compile_pattern(pattern)
+
+
+def _burst(loop: asyncio.AbstractEventLoop, server: Server, nuhr: str, ip: str) -> None:
+    # as line_read would have them; all waiting on the pool at once
+    checks = [server._check_triggers(nuhr, ip) for _ in range(BURST)]
+    loop.run_until_complete(asyncio.gather(*checks))
+
+
+def _cache_cycle(cache: PatternCache, pattern: str) -> None:
+    cache.acquire(pattern)
+    cache.release(pattern)
+
+
+def _trigger_pattern(i: int) -> str:
+    return [
+        f"/^[^@]+@2001:db8:{i:x}:\\S+ /",
+        f"/^spam{i}[0-9]+!/i",
+        f"'evil{i}.example'$",
+        f"2001:db8:{i:x}::/48",
+    ][i % 4]
+
+
+def _server(
+    config: Config, rule_count: int, pool: Optional[MatcherPool] = None
+) -> Server:
+    bot = Bot(config, None)  # type: ignore
+    server = Server(bot, "bench", config, None, pool=pool)  # type: ignore
+
+    now = datetime.utcnow()
+    triggers: List[Tuple[int, Trigger]] = []
+    rejects: List[Tuple[int, Reject]] = []
+    for i in range(rule_count):
+        action = [TriggerAction.IGNORE, TriggerAction.SCAN][i % 2]
+        trigger = Trigger(_trigger_pattern(i), "bench", "bench", action, now)
+        triggers.append((i, trigger))
+
+        pattern = f"/^matrix-appservice-irc 0\\.{i}\\.1 bridged via /"
+        reject = Reject(pattern, "bench", "bench", Action.BAN, "reason", now)
+        rejects.append((i, reject))
+
+    server._rules("add_triggers", triggers)
+    server._rules("add_rejects", rejects)
+    return server
+
+
+def _version_server(config: Config, rule_count: int) -> Server:
+    server = Server(Bot(config, None), "bench", config, None)  # type: ignore
+
+    now = datetime.utcnow()
+    rejects: List[Tuple[int, Reject]] = []
+    for i in range(rule_count):
+        # spread over a handful of products, like real version pins
+        pattern = f"product{i % 8} < 0.{i}.3"
+        reject = Reject(pattern, "bench", "bench", Action.BAN, "reason", now)
+        rejects.append((i, reject))
+
+    server._matcher.add_rejects(rejects)
+    return server
+
+
+@contextmanager
+def _burst_case(config: Config, pool_size: int) -> Iterator[Callable[[], Any]]:
+    # the worker processes need an event loop for as long as the case runs
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    pool: Optional[MatcherPool] = None
+    try:
+        if pool_size > 0:
+            pool = MatcherPool(pool_size)
+            pool.start()
+        server = _server(config, BURST_RULES, pool)
+        yield partial(_burst, loop, server, NUHR_REAL, "2001:db8:1:2::3")
+    finally:
+        if pool is not None:
+            pool.stop()
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def cases(config: Config) -> Iterator[Case]:
+    patterns = {"real": PATTERN_REAL, "adverse": PATTERN_ADVERSE}
+    for label, pattern in patterns.items():
+        yield Case(f"tokenize_pattern[{label}]", _plain(tokenize_pattern, pattern))
+        yield Case(f"compile_pattern[{label}]", _plain(_compile_pattern, pattern))
+
+    ctcps = {"real": CTCP_REAL, "adverse": CTCP_ADVERSE}
+    for label, ctcp in ctcps.items():
+        yield Case(f"re_version[{label}]", _plain(RE_VERSION.search, ctcp))
+
+    # a reconnect's worth of patterns we've already got compiled
+    cache = PatternCache()
+    cache.acquire(PATTERN_REAL)
+    yield Case("pattern_cache[hit]", _plain(_cache_cycle, cache, PATTERN_REAL))
+
+    versions = {"real": VERSION_REAL, "adverse": VERSION_ADVERSE}
+
+    cliconns = {"real": CLICONN_REAL, "adverse": CLICONN_ADVERSE}
+    for label, line in cliconns.items():
+        yield Case(f"cliconn[{label}]", _plain(config.cliconn.search, line))
+
+    nuhrs: Dict[str, Tuple[str, str]] = {
+        "real": (NUHR_REAL, "2001:db8:1:2::3"),
+        "adverse": (NUHR_ADVERSE, "c" * 64),
+    }
+    # built the first time a case that uses them is run, then shared
+    servers: Dict[Tuple[Callable[[Config, int], Server], int], Server] = {}
+
+    def server(build: Callable[[Config, int], Server], rule_count: int) -> Server:
+        if (build, rule_count) not in servers:
+            servers[(build, rule_count)] = build(config, rule_count)
+        return servers[(build, rule_count)]
+
+    for rule_count in RULE_COUNTS:
+        rule_server = partial(server, _server, rule_count)
+        for label, (nuhr, ip) in nuhrs.items():
+            yield Case(
+                f"check_triggers[{rule_count},{label}]",
+                partial(_with_server, rule_server, _check_triggers, nuhr, ip),
+            )
+        for label, version in versions.items():
+            yield Case(
+                f"check_rejects[{rule_count},{label}]",
+                partial(_with_server, rule_server, _check_rejects, version),
+            )
+
+        version_server = partial(server, _version_server, rule_count)
+        for label, version in versions.items():
+            yield Case(
+                f"check_version_rejects[{rule_count},{label}]",
+                partial(_with_server, version_server, _check_rejects, version),
+            )
+
+    for pool_size in POOL_SIZES:
+        label = "in-process" if pool_size == 0 else f"pool{pool_size}"
+        yield Case(
+            f"check_triggers_burst[{BURST_RULES},{label}]",
+            partial(_burst_case, config, pool_size),
+        )
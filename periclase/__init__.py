@@ -1,9 +1,24 @@
+import asyncio
 import traceback
-from collections import OrderedDict
+import tracemalloc
 from dataclasses import dataclass
+from functools import partial
+from ipaddress import ip_network
 from random import randint
 from re import compile as re_compile
-from typing import Awaitable, Callable, Dict, List, Optional, Pattern, Sequence, Tuple
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Coroutine,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+)
 
 from irctokens import build, Hostmask, Line
 from ircrobots import Bot as BaseBot
@@ -15,15 +30,24 @@ from ircstates.numerics import (
     RPL_RSACHALLENGE2,
     RPL_ENDOFRSACHALLENGE2,
 )
+from ircrobots.interface import IServer, SendPriority
 from ircrobots.ircv3 import Capability
 from ircrobots.matching import ANY, Response, SELF
 from ircchallenge import Challenge
 
 from .config import Config
 from .database import Database
-from .database.reject import Action, Reject
-from .database.trigger import Trigger, TriggerAction
-from .utils import compile_pattern, lex_pattern
+from .database.reject import Action
+from .database.trigger import TriggerAction
+from .diagnostics import LagWatchdog, memory_top
+from .matcher import Matcher
+from .pool import MatcherPool
+from .sweep import RPL_ENDOFTRACE, RPL_ETRACE, Sweep, SweepState, parse_etrace
+from .tasks import TaskQueue
+from .utils import parse_cidr, tokenize_pattern
+from .version import parse_rule
+
+T = TypeVar("T")
 
 CAP_OPER = Capability(None, "solanum.chat/oper")
 CAP_REALHOST = Capability(None, "solanum.chat/realhost")
@@ -32,7 +56,7 @@ URL = "https://github.com/Libera-Chat/periclase"
 OUR_CTCP = {"VERSION": f"periclase CTCP VERSION scanner ({URL})", "SOURCE": URL}
 
 RE_VERSION = re_compile(r"^\x01VERSION (?P<version>.*?)\x01?$")
-RE_NUHR = re_compile(r"^(?P<nick>[^!]+)![^@]+@\S+ .+$")
+RE_NUHR = re_compile(r"^(?P<nick>[^!]+)![^@]+@(?P<host>\S+) .+$")
 
 
 @dataclass
@@ -43,16 +67,46 @@ class Caller:
 
 
 class Server(BaseServer):
-    def __init__(self, bot: BaseBot, name: str, config: Config, database: Database):
+    def __init__(
+        self,
+        bot: BaseBot,
+        name: str,
+        config: Config,
+        database: Database,
+        watchdog: Optional[LagWatchdog] = None,
+        pool: Optional[MatcherPool] = None,
+        matcher: Optional[Matcher] = None,
+    ):
         super().__init__(bot, name)
         self._config = config
         self._database = database
+        self._watchdog = watchdog
 
         self.desired_caps.add(CAP_OPER)
         self.desired_caps.add(CAP_REALHOST)
 
-        self._triggers: OrderedDict[int, Tuple[Pattern, Trigger]] = OrderedDict()
-        self._rejects: OrderedDict[int, Tuple[Pattern, Reject]] = OrderedDict()
+        # the Bot's, if it's given us one, so it outlives reconnects
+        self._matcher = matcher or Matcher()
+        self._pool = pool
+
+        # operator commands run off to the side so they can't hold up scanning,
+        # and rule changes are persisted one at a time, in order
+        self._commands = TaskQueue(
+            config.cmd_workers, config.cmd_timeout, config.cmd_queue
+        )
+        self._writes = TaskQueue(1)
+
+        self._sweep: Optional[Sweep] = None
+        # connections and CTCP VERSION responses being matched by the pool
+        self._scans: Set["asyncio.Task[None]"] = set()
+
+    def stop_tasks(self) -> None:
+        self._commands.stop()
+        self._writes.stop()
+        for task in self._scans:
+            task.cancel()
+        if self._sweep is not None and self._sweep.active:
+            self._sweep.cancel()
 
     def set_throttle(self, rate: int, time: float):
         # turn off throttling
@@ -76,6 +130,50 @@ class Server(BaseServer):
     async def _audit(self, text: str):
         await self.send(build("NOTICE", [self._config.audit, text]))
 
+    def _persist(self, func: Callable[[], Awaitable[T]]) -> Awaitable[T]:
+        # `func` writes to the database and then applies the change in memory.
+        # shielded so a timed out command doesn't abandon a half-done change
+        return asyncio.shield(self._writes.put(func))
+
+    async def _hold_pattern(self, pattern: str, func: Callable[[], Awaitable[T]]) -> T:
+        # compile `pattern` (or find it already compiled) before we store
+        # anything, which also makes sure it's valid, and keep it compiled until
+        # `func` has added the rule that uses it
+        if parse_cidr(pattern) is not None or parse_rule(pattern) is not None:
+            return await self._persist(func)
+
+        self._matcher.patterns.acquire(pattern)
+        try:
+            return await self._persist(func)
+        finally:
+            self._matcher.patterns.release(pattern)
+
+    def _queue_cmd(
+        self,
+        who: Hostmask,
+        target: str,
+        command: str,
+        args: str,
+        tags: Optional[Dict[str, str]],
+    ) -> None:
+        try:
+            future = self._commands.put(
+                partial(self.cmd, who, target, command, args, tags)
+            )
+        except asyncio.QueueFull:
+            self.send(build("NOTICE", [target, "busy, please try again later"]))
+        else:
+            future.add_done_callback(partial(self._cmd_done, target))
+
+    def _cmd_done(self, target: str, future: "asyncio.Future[None]") -> None:
+        if future.cancelled():
+            pass
+        elif isinstance(e := future.exception(), asyncio.TimeoutError):
+            self.send(build("NOTICE", [target, "error: command timed out"]))
+        elif e is not None:
+            traceback.print_exception(type(e), e, e.__traceback__)
+            self.send(build("NOTICE", [target, "error: command failed"]))
+
     async def _oper_up(self, oper_name: str, oper_file: str, oper_pass: str):
 
         try:
@@ -98,41 +196,94 @@ class Server(BaseServer):
                     await self.send(build("CHALLENGE", [f"+{retort}"]))
                     break
 
-    def _sort_triggers(self) -> None:
-        # sort by action; DISABLED, IGNORE, QUIETSCAN, SCAN
-        self._triggers = OrderedDict(
-            sorted(self._triggers.items(), key=lambda a: a[1][1].action)
-        )
-
-    async def _check_triggers(self, nuhr: str) -> Optional[Tuple[int, TriggerAction]]:
-        for trigger_id, (trigger_pattern, trigger) in self._triggers.items():
-            if trigger.action == TriggerAction.DISABLED or not trigger_pattern.search(
-                nuhr
-            ):
-                continue
-            return (trigger_id, trigger.action)
-        return None
+    def _rules(self, kind: str, *args: Any) -> None:
+        # change our rule set and, if we have one, our worker pool's too
+        getattr(self._matcher, kind)(*args)
+        if self._pool is not None and self._pool.running:
+            self._pool.update(kind, *args)
+
+    async def _check_triggers(
+        self, nuhr: str, ip: Optional[str] = None
+    ) -> Optional[Tuple[int, TriggerAction]]:
+        if self._pool is not None and self._pool.running:
+            try:
+                return await self._pool.check_triggers(nuhr, ip)
+            except EOFError:
+                pass
+        return self._matcher.check_triggers(nuhr, ip)
 
     async def _check_rejects(self, version: str) -> Optional[int]:
-        for reject_id, (reject_pattern, _) in self._rejects.items():
-            if reject_pattern.search(version):
-                return reject_id
+        if self._pool is not None and self._pool.running:
+            try:
+                return await self._pool.check_rejects(version)
+            except EOFError:
+                pass
+        return self._matcher.check_rejects(version)
+
+    async def _scan(self, coro: Coroutine[Any, Any, None]) -> None:
+        if self._pool is not None and self._pool.running:
+            # don't wait for the pool, so we can read the lines after this one
+            # and the pool gets them all in one batch
+            task = asyncio.create_task(coro)
+            self._scans.add(task)
+            task.add_done_callback(self._scan_done)
         else:
-            return None
+            await coro
+
+    def _scan_done(self, task: "asyncio.Task[None]") -> None:
+        self._scans.discard(task)
+        if task.cancelled():
+            pass
+        elif (e := task.exception()) is not None:
+            traceback.print_exception(type(e), e, e.__traceback__)
+
+    async def _triggered(
+        self,
+        nickname: str,
+        nuhr: str,
+        trigger_id: int,
+        trigger_action: TriggerAction,
+        priority: SendPriority = SendPriority.MEDIUM,
+    ) -> None:
+        await self._log(f"TRIGGER:{trigger_action.name}: {trigger_id} {nuhr}")
+        if trigger_action == TriggerAction.SCAN:
+            await self.send(build("NOTICE", [nickname, self._config.notify]), priority)
+        if trigger_action in {TriggerAction.SCAN, TriggerAction.QUIETSCAN}:
+            await self.send(build("PRIVMSG", [nickname, "\x01VERSION\x01"]), priority)
+
+    async def _scan_cliconn(self, nickname: str, nuhr: str, ip: str) -> None:
+        matched_trigger = await self._check_triggers(nuhr, ip)
+        if matched_trigger is not None:
+            trigger_id, trigger_action = matched_trigger
+            await self._triggered(nickname, nuhr, trigger_id, trigger_action)
+
+    async def _scan_version(self, nickname: str, version: str, ip: str) -> None:
+        matched_reject = await self._check_rejects(version)
+        # the reject might have been removed while we were matching; if it
+        # was, treat it as though nothing matched
+        matched = None
+        if matched_reject is not None:
+            matched = self._matcher.rejects.get(matched_reject)
+
+        if matched is not None:
+            # GET THEY ASS
+            _, reject = matched
+            await self._log(f"BAD: {matched_reject} {nickname} {version}")
+            if reject.action == Action.BAN:
+                await self.send(build("KLINE", ["10", f"*@{ip}", reject.reason]))
+            else:
+                await self.send(build("NOTICE", [nickname, reject.reason]))
+        else:
+            await self._log(f"FINE: {nickname} {version}")
 
     async def line_read(self, line: Line):
         if line.command == RPL_WELCOME:
-            triggers = await self._database.trigger.list()
-            for trigger_id, trigger in triggers:
-                self._triggers[trigger_id] = (
-                    compile_pattern(trigger.pattern),
-                    trigger,
-                )
-            self._sort_triggers()
+            self._commands.start()
+            self._writes.start()
 
+            triggers = await self._database.trigger.list()
             rejects = await self._database.reject.list()
-            for reject_id, reject in rejects:
-                self._rejects[reject_id] = (compile_pattern(reject.pattern), reject)
+            self._rules("load", triggers, rejects)
 
             oper_name, oper_file, oper_pass = self._config.oper
             await self._oper_up(oper_name, oper_file, oper_pass)
@@ -142,20 +293,24 @@ class Server(BaseServer):
             # c near cliconn
             await self.send(build("MODE", [self.nickname, "-s+s", "+Fc"]))
 
+        elif (
+            line.command in {RPL_ETRACE, RPL_ENDOFTRACE}
+            and self._sweep is not None
+            and self._sweep.state == SweepState.ENUMERATING
+        ):
+            if line.command == RPL_ENDOFTRACE:
+                self._sweep.start()
+            elif (user := parse_etrace(line)) is not None:
+                self._sweep.add_user(user)
+
         elif p_cliconn := self._config.cliconn.search(line.format()):
             nickname = p_cliconn.group("nick")
             userhost = p_cliconn.group("userhost")
             realname = p_cliconn.group("real")
             nuhr = f"{nickname}!{userhost} {realname}"
-
-            matched_trigger = await self._check_triggers(nuhr)
-            if matched_trigger is not None:
-                trigger_id, trigger_action = matched_trigger
-                await self._log(f"TRIGGER:{trigger_action.name}: {trigger_id} {nuhr}")
-                if trigger_action == TriggerAction.SCAN:
-                    await self.send(build("NOTICE", [nickname, self._config.notify]))
-                if trigger_action in {TriggerAction.SCAN, TriggerAction.QUIETSCAN}:
-                    await self.send(build("PRIVMSG", [nickname, "\x01VERSION\x01"]))
+            # prefer the `ip` group if cliconn has one, else the hostname
+            ip = p_cliconn.groupdict().get("ip") or userhost.rpartition("@")[2]
+            await self._scan(self._scan_cliconn(nickname, nuhr, ip))
 
         elif (
             line.command == "NOTICE"
@@ -167,22 +322,7 @@ class Server(BaseServer):
         ):
             # CTCP VERSION response
             version = p_version.group("version")
-
-            matched_reject = await self._check_rejects(version)
-            if matched_reject is not None:
-                # GET THEY ASS
-                _, reject = self._rejects[matched_reject]
-                await self._log(
-                    f"BAD: {matched_reject} {line.hostmask.nickname} {version}"
-                )
-                if reject.action == Action.BAN:
-                    await self.send(build("KLINE", ["10", f"*@{ip}", reject.reason]))
-                else:
-                    await self.send(
-                        build("NOTICE", [line.hostmask.nickname, reject.reason])
-                    )
-            else:
-                await self._log(f"FINE: {line.hostmask.nickname} {version}")
+            await self._scan(self._scan_version(line.hostmask.nickname, version, ip))
 
         elif (
             line.command == "PRIVMSG"
@@ -214,7 +354,7 @@ class Server(BaseServer):
             # private message
             await self._audit(f"[PV] <{line.source}> {line.params[1]}")
             cmd, _, args = line.params[1].partition(" ")
-            await self.cmd(
+            self._queue_cmd(
                 line.hostmask, line.hostmask.nickname, cmd.lower(), args, line.tags
             )
 
@@ -229,7 +369,7 @@ class Server(BaseServer):
             if first in {f"{self.nickname}{c}" for c in [":", ",", ""]} and rest:
                 # highlight
                 cmd, _, args = rest.partition(" ")
-                await self.cmd(
+                self._queue_cmd(
                     line.hostmask, line.params[0], cmd.lower(), args, line.tags
                 )
 
@@ -263,7 +403,7 @@ class Server(BaseServer):
         if nuhr is None:
             return ["please provide `nickname!username@hostname realname`"]
 
-        matched_trigger = await self._check_triggers(sargs)
+        matched_trigger = await self._check_triggers(sargs, nuhr.group("host"))
         if matched_trigger is None:
             return ["no trigger matched"]
 
@@ -272,26 +412,165 @@ class Server(BaseServer):
         await self.send(build("PRIVMSG", [nuhr.group("nick"), "\x01VERSION\x01"]))
         return []
 
+    async def _sweep_triggered(
+        self, nickname: str, nuhr: str, trigger_id: int, trigger_action: TriggerAction
+    ) -> None:
+        # low priority so we don't hold up anything we send for live scanning
+        await self._triggered(
+            nickname, nuhr, trigger_id, trigger_action, SendPriority.LOW
+        )
+
+    async def _cmd_sweep_start(self, caller: Caller, sargs: str) -> Sequence[str]:
+        if self._sweep is not None and self._sweep.active:
+            return [f"sweep already in progress ({self._sweep.status()})"]
+
+        self._sweep = Sweep(
+            self._config.sweep_rate,
+            self._check_triggers,
+            self._sweep_triggered,
+            self._log,
+        )
+        await self.send(build("ETRACE"))
+        await self._log(f"SWEEP: started by {caller.oper}")
+        return ["started sweep"]
+
+    async def _cmd_sweep_status(self, caller: Caller, sargs: str) -> Sequence[str]:
+        if self._sweep is None:
+            return ["no sweep has been run"]
+        return [self._sweep.status()]
+
+    async def _cmd_sweep_pause(self, caller: Caller, sargs: str) -> Sequence[str]:
+        if self._sweep is None or not self._sweep.state == SweepState.RUNNING:
+            return ["no sweep running"]
+
+        self._sweep.pause()
+        return [f"paused sweep ({self._sweep.status()})"]
+
+    async def _cmd_sweep_resume(self, caller: Caller, sargs: str) -> Sequence[str]:
+        if self._sweep is None or not self._sweep.state == SweepState.PAUSED:
+            return ["no sweep paused"]
+
+        self._sweep.start()
+        return [f"resumed sweep ({self._sweep.status()})"]
+
+    async def _cmd_sweep_cancel(self, caller: Caller, sargs: str) -> Sequence[str]:
+        if self._sweep is None or not self._sweep.active:
+            return ["no sweep in progress"]
+
+        self._sweep.cancel()
+        await self._log(f"SWEEP: cancelled by {caller.oper}")
+        return [f"cancelled sweep ({self._sweep.status()})"]
+
+    async def cmd_sweep(self, caller: Caller, sargs: str) -> Sequence[str]:
+        subcmds: Dict[str, Callable[[Caller, str], Awaitable[Sequence[str]]]] = {
+            "START": self._cmd_sweep_start,
+            "STATUS": self._cmd_sweep_status,
+            "PAUSE": self._cmd_sweep_pause,
+            "RESUME": self._cmd_sweep_resume,
+            "CANCEL": self._cmd_sweep_cancel,
+        }
+        subcmd_keys = ", ".join(subcmds.keys())
+
+        subcmd, _, sargs = sargs.partition(" ")
+        if subcmd == "":
+            return [f"please provide a subcommand ({subcmd_keys})"]
+
+        subcmd = subcmd.upper()
+        if not subcmd in subcmds:
+            return [f"unknown subcommand '{subcmd}', expectected {subcmd_keys}"]
+
+        subcmd_func = subcmds[subcmd]
+        return await subcmd_func(caller, sargs)
+
+    async def _cmd_debug_lag(self, caller: Caller, sargs: str) -> Sequence[str]:
+        if self._watchdog is None:
+            return ["lag watchdog is disabled (see debug.lag_threshold)"]
+
+        percents = [50, 90, 99, 100]
+        lags = self._watchdog.percentiles(percents)
+        lags_s = ", ".join(f"p{p} {l * 1000:.1f}ms" for p, l in zip(percents, lags))
+        return [f"loop lag over {len(self._watchdog.samples)} samples: {lags_s}"]
+
+    async def _cmd_debug_memory(self, caller: Caller, sargs: str) -> Sequence[str]:
+        if (sargs := sargs.strip().upper()) == "START":
+            tracemalloc.start()
+            return ["started tracemalloc"]
+        elif sargs == "STOP":
+            tracemalloc.stop()
+            return ["stopped tracemalloc"]
+        elif not tracemalloc.is_tracing():
+            return ["tracemalloc is not running (debug memory start)"]
+
+        # this takes a while, but it's only when someone explicitly asks
+        current, peak = tracemalloc.get_traced_memory()
+        return [
+            *memory_top(10),
+            f"traced {current / 1024:.1f}KiB (peak {peak / 1024:.1f}KiB)",
+        ]
+
+    async def _cmd_debug_sizes(self, caller: Caller, sargs: str) -> Sequence[str]:
+        cidr_count = sum(1 for p, _ in self._matcher.triggers.values() if p is None)
+        version_count = sum(1 for p, _ in self._matcher.rejects.values() if p is None)
+        sweep_count = 0 if self._sweep is None else len(self._sweep.users)
+        return [
+            f"triggers: {len(self._matcher.triggers)} ({cidr_count} CIDR)",
+            f"rejects: {len(self._matcher.rejects)} ({version_count} version)",
+            f"compiled patterns: {len(self._matcher.patterns)}",
+            f"users: {len(self.users)}, channels: {len(self.channels)}",
+            f"queued commands: {self._commands.qsize()}",
+            f"queued writes: {self._writes.qsize()}",
+            f"queued sends: {self._send_queue.qsize()}",
+            f"sweep users: {sweep_count}",
+        ]
+
+    async def cmd_debug(self, caller: Caller, sargs: str) -> Sequence[str]:
+        subcmds: Dict[str, Callable[[Caller, str], Awaitable[Sequence[str]]]] = {
+            "LAG": self._cmd_debug_lag,
+            "MEMORY": self._cmd_debug_memory,
+            "SIZES": self._cmd_debug_sizes,
+        }
+        subcmd_keys = ", ".join(subcmds.keys())
+
+        subcmd, _, sargs = sargs.partition(" ")
+        if subcmd == "":
+            return [f"please provide a subcommand ({subcmd_keys})"]
+
+        subcmd = subcmd.upper()
+        if not subcmd in subcmds:
+            return [f"unknown subcommand '{subcmd}', expectected {subcmd_keys}"]
+
+        subcmd_func = subcmds[subcmd]
+        return await subcmd_func(caller, sargs)
+
     async def _cmd_reject_add(self, caller: Caller, sargs: str) -> Sequence[str]:
-        if sargs.strip() == "":
+        if (sargs := sargs.strip()) == "":
             return ["please provide a reject pattern and reason"]
 
-        # this may through ValueError, but up-stack will handle it nicely
-        p_delim, pattern, p_flags, reason = lex_pattern(sargs)
+        kind, _, version_sargs = sargs.partition(" ")
+        if kind.upper() == "VERSION":
+            # `version <product> <op> <version> <reason>`
+            rule_parts = version_sargs.strip().split(" ", 3)
+            pattern = " ".join(rule_parts[:3])
+            if parse_rule(pattern) is None:
+                return ["please provide a version rule, e.g. `foo < 1.2.3`"]
+            reason = rule_parts[3] if len(rule_parts) > 3 else ""
+        else:
+            # this may through ValueError, but up-stack will handle it nicely
+            token, reason = tokenize_pattern(sargs)
+            pattern = token.canonical
 
         if reason.strip() == "":
             return ["please provide a reject reason"]
 
-        # TODO: kinda strange that we totally re-create the pattern
-        pattern = f"{chr(p_delim)}{pattern}{chr(p_delim)}{p_flags}"
-        reject_id = await self._database.reject.add(
-            pattern, caller.source, caller.oper, Action.BAN, reason
-        )
-        self._rejects[reject_id] = (
-            compile_pattern(pattern),
-            await self._database.reject.get(reject_id),
-        )
+        async def _add() -> int:
+            reject_id = await self._database.reject.add(
+                pattern, caller.source, caller.oper, Action.BAN, reason
+            )
+            reject = await self._database.reject.get(reject_id)
+            self._rules("add_rejects", [(reject_id, reject)])
+            return reject_id
 
+        reject_id = await self._hold_pattern(pattern, _add)
         return [f"added reject {reject_id}"]
 
     async def _cmd_reject_get(self, caller: Caller, sargs: str) -> Sequence[str]:
@@ -301,10 +580,10 @@ class Server(BaseServer):
             return [f"'{sargs}' is not a valid reject id"]
 
         reject_id = int(sargs)
-        if not reject_id in self._rejects:
+        if not reject_id in self._matcher.rejects:
             return ["unknown reject id"]
 
-        _, reject = self._rejects[reject_id]
+        _, reject = self._matcher.rejects[reject_id]
         return [
             reject.pattern,
             f"reason: {reject.reason}",
@@ -319,21 +598,26 @@ class Server(BaseServer):
             return [f"'{sargs}' is not a valid reject id"]
 
         reject_id = int(sargs)
-        if not reject_id in self._rejects:
+        if not reject_id in self._matcher.rejects:
             return ["unknown reject id"]
 
-        _, reject = self._rejects.pop(reject_id)
-        await self._database.reject.remove(reject_id)
+        _, reject = self._matcher.rejects[reject_id]
+
+        async def _remove() -> None:
+            await self._database.reject.remove(reject_id)
+            self._rules("remove_reject", reject_id)
+
+        await self._persist(_remove)
         return [f"removed reject {reject_id} ({reject.pattern})"]
 
     async def _cmd_reject_list(self, caller: Caller, sargs: str) -> Sequence[str]:
-        if not self._rejects:
+        if not self._matcher.rejects:
             return ["no rejects"]
 
         output: List[str] = []
 
-        col_max = max(len(str(reject_id)) for reject_id in self._rejects.keys())
-        for reject_id, (_, reject) in self._rejects.items():
+        col_max = max(len(str(reject_id)) for reject_id in self._matcher.rejects.keys())
+        for reject_id, (_, reject) in self._matcher.rejects.items():
             reject_id_s = str(reject_id).rjust(col_max)
             output.append(f"{reject_id_s}: {reject.pattern}")
 
@@ -364,8 +648,17 @@ class Server(BaseServer):
         if (sargs := sargs.strip()) == "":
             return ["please provide a trigger pattern"]
 
-        # this may through ValueError, but up-stack will handle it nicely
-        p_delim, pattern, p_flags, action_name = lex_pattern(sargs)
+        kind, _, cidr_sargs = sargs.partition(" ")
+        if kind.upper() == "CIDR":
+            cidr, _, action_name = cidr_sargs.strip().partition(" ")
+            if cidr == "":
+                return ["please provide a CIDR range"]
+            # this may through ValueError, but up-stack will handle it nicely
+            pattern = str(ip_network(cidr))
+        else:
+            # this may through ValueError, but up-stack will handle it nicely
+            token, action_name = tokenize_pattern(sargs)
+            pattern = token.canonical
 
         action_name, *_ = action_name.upper().split(" ", 1)
         action_names = sorted([a.name for a in TriggerAction])
@@ -375,17 +668,15 @@ class Server(BaseServer):
 
         action = TriggerAction[action_name]
 
-        # TODO: kinda strange that we totally re-create the pattern
-        pattern = f"{chr(p_delim)}{pattern}{chr(p_delim)}{p_flags}"
-        trigger_id = await self._database.trigger.add(
-            pattern, caller.source, caller.oper, action
-        )
-        self._triggers[trigger_id] = (
-            compile_pattern(pattern),
-            await self._database.trigger.get(trigger_id),
-        )
-        self._sort_triggers()
+        async def _add() -> int:
+            trigger_id = await self._database.trigger.add(
+                pattern, caller.source, caller.oper, action
+            )
+            trigger = await self._database.trigger.get(trigger_id)
+            self._rules("add_triggers", [(trigger_id, trigger)])
+            return trigger_id
 
+        trigger_id = await self._hold_pattern(pattern, _add)
         return [f"added trigger {trigger_id}"]
 
     async def _cmd_trigger_set(self, caller: Caller, sargs: str) -> Sequence[str]:
@@ -396,7 +687,7 @@ class Server(BaseServer):
             return [f"'{sargs}' is not a valid trigger id"]
 
         trigger_id = int(trigger_id_s)
-        if not trigger_id in self._triggers:
+        if not trigger_id in self._matcher.triggers:
             return ["unknown trigger id"]
 
         if (action_name := action_name.strip().upper()) == "":
@@ -408,15 +699,15 @@ class Server(BaseServer):
             return [f"unknown action '{action_name}', expected {action_names_s}"]
 
         action = TriggerAction[action_name]
-        _, trigger = self._triggers[trigger_id]
+        _, trigger = self._matcher.triggers[trigger_id]
         if trigger.action == action:
             return [f"trigger {trigger_id} is already {action_name}"]
 
-        await self._database.trigger.set(trigger_id, action)
-
-        trigger.action = action
-        self._sort_triggers()
+        async def _set() -> None:
+            await self._database.trigger.set(trigger_id, action)
+            self._rules("set_trigger", trigger_id, action)
 
+        await self._persist(_set)
         return [f"set triger {trigger_id} to {action_name}"]
 
     async def _cmd_trigger_get(self, caller: Caller, sargs: str) -> Sequence[str]:
@@ -426,10 +717,10 @@ class Server(BaseServer):
             return [f"'{sargs}' is not a valid trigger id"]
 
         trigger_id = int(sargs)
-        if not trigger_id in self._triggers:
+        if not trigger_id in self._matcher.triggers:
             return ["unknown trigger id"]
 
-        _, trigger = self._triggers[trigger_id]
+        _, trigger = self._matcher.triggers[trigger_id]
         return [
             trigger.pattern,
             f"action: {trigger.action.name}",
@@ -444,23 +735,30 @@ class Server(BaseServer):
             return [f"'{sargs}' is not a valid trigger id"]
 
         trigger_id = int(sargs)
-        if not trigger_id in self._triggers:
+        if not trigger_id in self._matcher.triggers:
             return ["unknown trigger id"]
 
-        _, trigger = self._triggers.pop(trigger_id)
-        await self._database.trigger.remove(trigger_id)
+        _, trigger = self._matcher.triggers[trigger_id]
+
+        async def _remove() -> None:
+            await self._database.trigger.remove(trigger_id)
+            self._rules("remove_trigger", trigger_id)
+
+        await self._persist(_remove)
         return [f"removed trigger {trigger_id} ({trigger.pattern})"]
 
     # TODO: this is a lot of code duplication. what can we do about that?
     async def _cmd_trigger_list(self, caller: Caller, sargs: str) -> Sequence[str]:
-        if not self._triggers:
+        if not self._matcher.triggers:
             return ["no triggers"]
 
         output: List[str] = []
 
-        col_max = max(len(str(trigger_id)) for trigger_id in self._triggers.keys())
+        col_max = max(
+            len(str(trigger_id)) for trigger_id in self._matcher.triggers.keys()
+        )
         last_action: Optional[TriggerAction] = None
-        for trigger_id, (_, trigger) in self._triggers.items():
+        for trigger_id, (_, trigger) in self._matcher.triggers.items():
             if last_action is None or not trigger.action == last_action:
                 last_action = trigger.action
                 output.append(f"{trigger.action.name}:")
@@ -468,7 +766,7 @@ class Server(BaseServer):
             trigger_id_s = str(trigger_id).rjust(col_max)
             output.append(f"  {trigger_id_s}: {trigger.pattern}")
 
-        output.append(f"({len(self._triggers)} total)")
+        output.append(f"({len(self._matcher.triggers)} total)")
         return output
 
     # TODO: this is a lot of code duplication. what can we do about that?
@@ -500,5 +798,40 @@ class Bot(BaseBot):
         self._config = config
         self._database = database
 
+        self._matcher = Matcher()
+        self._pool: Optional[MatcherPool] = None
+        if config.match_processes > 0:
+            self._pool = MatcherPool(config.match_processes)
+
+        self._watchdog: Optional[LagWatchdog] = None
+        if config.lag_threshold is not None:
+            self._watchdog = LagWatchdog(config.lag_threshold)
+
     def create_server(self, name: str):
-        return Server(self, name, self._config, self._database)
+        return Server(
+            self,
+            name,
+            self._config,
+            self._database,
+            self._watchdog,
+            self._pool,
+            self._matcher,
+        )
+
+    async def run(self):
+        if self._watchdog is not None:
+            self._watchdog.start()
+        if self._pool is not None:
+            self._pool.start()
+        try:
+            await super().run()
+        finally:
+            if self._watchdog is not None:
+                self._watchdog.stop()
+            if self._pool is not None:
+                self._pool.stop()
+
+    async def disconnected(self, server: IServer):
+        if isinstance(server, Server):
+            server.stop_tasks()
+        await super().disconnected(server)
@@ -0,0 +1,80 @@
+from ipaddress import IPv4Address, IPv6Address, IPv4Network, IPv6Network
+from typing import Dict, Iterator, List, Optional, Set, Union
+
+IPAddress = Union[IPv4Address, IPv6Address]
+IPNetwork = Union[IPv4Network, IPv6Network]
+
+
+class _Node(object):
+    __slots__ = ("children", "values")
+
+    def __init__(self) -> None:
+        self.children: List[Optional[_Node]] = [None, None]
+        self.values: Set[int] = set()
+
+
+class CIDRTrie(object):
+    """
+    binary radix trie of IP networks, one root per address family. every
+    network holds a set of ids (e.g. trigger ids) and lookups walk at most
+    one node per address bit.
+    """
+
+    def __init__(self) -> None:
+        self._roots: Dict[int, _Node] = {4: _Node(), 6: _Node()}
+
+    def _bits(self, network: IPNetwork) -> Iterator[int]:
+        address = int(network.network_address)
+        max_len = network.max_prefixlen
+        for i in range(network.prefixlen):
+            yield (address >> (max_len - 1 - i)) & 1
+
+    def add(self, network: IPNetwork, value: int) -> None:
+        node = self._roots[network.version]
+        for bit in self._bits(network):
+            child = node.children[bit]
+            if child is None:
+                child = node.children[bit] = _Node()
+            node = child
+        node.values.add(value)
+
+    def remove(self, network: IPNetwork, value: int) -> None:
+        path = [self._roots[network.version]]
+        bits = list(self._bits(network))
+        for bit in bits:
+            child = path[-1].children[bit]
+            if child is None:
+                return
+            path.append(child)
+
+        path[-1].values.discard(value)
+        # prune nodes that no longer lead anywhere
+        for bit in reversed(bits):
+            node = path.pop()
+            if node.values or any(node.children):
+                break
+            path[-1].children[bit] = None
+
+    def lookup(self, address: IPAddress) -> Iterator[Set[int]]:
+        """
+        yield sets of values of every network containing `address`, longest
+        prefix first
+        """
+
+        if isinstance(address, IPv6Address) and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+
+        node: Optional[_Node] = self._roots[address.version]
+        matches: List[Set[int]] = []
+        address_int = int(address)
+        max_len = address.max_prefixlen
+        i = 0
+        while node is not None:
+            if node.values:
+                matches.append(node.values)
+            if i == max_len:
+                break
+            node = node.children[(address_int >> (max_len - 1 - i)) & 1]
+            i += 1
+
+        return reversed(matches)
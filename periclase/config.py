@@ -27,6 +27,16 @@ class Config(object):
     db_host: Optional[str]
     db_name: str
 
+    cmd_workers: int
+    cmd_timeout: float
+    cmd_queue: int
+
+    sweep_rate: float
+
+    lag_threshold: Optional[float]
+
+    match_processes: int
+
 
 def load(filepath: str):
     with open(filepath) as file:
@@ -38,6 +48,11 @@ def load(filepath: str):
     oper_file = expanduser(config_yaml["oper"]["file"])
     oper_pass = config_yaml["oper"]["pass"]
 
+    commands = config_yaml.get("commands", {})
+    sweep = config_yaml.get("sweep", {})
+    debug = config_yaml.get("debug", {})
+    matching = config_yaml.get("matching", {})
+
     return Config(
         config_yaml["server"],
         nickname,
@@ -54,4 +69,10 @@ def load(filepath: str):
         config_yaml["database"].get("pass", None),
         config_yaml["database"].get("host", None),
         config_yaml["database"]["name"],
+        commands.get("workers", 4),
+        commands.get("timeout", 30.0),
+        commands.get("queue", 64),
+        sweep.get("rate", 5.0),
+        debug.get("lag_threshold", None),
+        matching.get("processes", 0),
     )
@@ -0,0 +1,84 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import deque
+from typing import Deque, List, Optional
+
+# how many lag samples we keep for percentiles
+SAMPLES = 1024
+
+
+class LagWatchdog(object):
+    """
+    measures how late the event loop runs a timer, and dumps the loop
+    thread's stack from a separate thread when the loop hasn't run that timer
+    for longer than `threshold` seconds
+    """
+
+    def __init__(self, threshold: float) -> None:
+        self.threshold = threshold
+        self._interval = threshold / 5
+        self.samples: Deque[float] = deque(maxlen=SAMPLES)
+
+        self._beat = time.monotonic()
+        self._loop_thread = threading.get_ident()
+        self._stop = threading.Event()
+        self._task: Optional["asyncio.Task[None]"] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.create_task(self._measure())
+        self._thread = threading.Thread(
+            target=self._watch, name="periclase-watchdog", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _measure(self) -> None:
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self._interval)
+            self._beat = now = time.monotonic()
+            self.samples.append(max(0.0, now - before - self._interval))
+
+    def _watch(self) -> None:
+        dumped_beat: Optional[float] = None
+        while not self._stop.wait(self._interval):
+            beat = self._beat
+            # the timer isn't due until `_interval` after the last beat
+            stalled = time.monotonic() - beat - self._interval
+            if stalled > self.threshold and not beat == dumped_beat:
+                # only dump once per stall
+                dumped_beat = beat
+                frame = sys._current_frames().get(self._loop_thread)
+                stack = "".join(traceback.format_stack(frame)) if frame else ""
+                print(
+                    f"! event loop blocked for {stalled:.3f}s:\n{stack}",
+                    file=sys.stderr,
+                )
+
+    def percentiles(self, percents: List[int]) -> List[float]:
+        samples = sorted(self.samples)
+        if not samples:
+            return [0.0 for _ in percents]
+        return [
+            samples[min(len(samples) - 1, len(samples) * p // 100)] for p in percents
+        ]
+
+
+def memory_top(limit: int) -> List[str]:
+    snapshot = tracemalloc.take_snapshot()
+    stats = snapshot.statistics("lineno")[:limit]
+    return [
+        f"{stat.size / 1024:.1f}KiB {stat.count} blocks {stat.traceback[0]}"
+        for stat in stats
+    ]
@@ -0,0 +1,164 @@
+from collections import OrderedDict
+from ipaddress import ip_address, ip_network
+from typing import List, Optional, Pattern, Sequence, Tuple
+
+from .cidr import CIDRTrie
+from .database.reject import Reject
+from .database.trigger import Trigger, TriggerAction
+from .utils import PatternCache, parse_cidr
+from .version import VersionIndex, parse_rule
+
+
+class Matcher(object):
+    """
+    the in-memory rule set; triggers and rejects with everything needed to
+    match against them. this is all plain data, so that it can be mirrored in
+    worker processes
+    """
+
+    def __init__(self) -> None:
+        # CIDR triggers have no Pattern; they're matched through _cidr_triggers
+        self.triggers: OrderedDict[int, Tuple[Optional[Pattern], Trigger]] = (
+            OrderedDict()
+        )
+        self._cidr_triggers = CIDRTrie()
+        # likewise version rejects, through _version_rejects
+        self.rejects: OrderedDict[int, Tuple[Optional[Pattern], Reject]] = OrderedDict()
+        self._version_rejects = VersionIndex()
+        # shared by triggers and rejects, and kept over clear()/load()
+        self.patterns = PatternCache()
+
+    def clear(self) -> None:
+        for trigger_pattern, trigger in self.triggers.values():
+            if trigger_pattern is not None:
+                self.patterns.release(trigger.pattern)
+        for reject_pattern, reject in self.rejects.values():
+            if reject_pattern is not None:
+                self.patterns.release(reject.pattern)
+
+        self.triggers.clear()
+        self._cidr_triggers = CIDRTrie()
+        self.rejects.clear()
+        self._version_rejects = VersionIndex()
+
+    def load(
+        self,
+        triggers: Sequence[Tuple[int, Trigger]],
+        rejects: Sequence[Tuple[int, Reject]],
+    ) -> None:
+        # replace the whole rule set, without recompiling patterns we already
+        # have; hold the new patterns before clear() lets go of the old ones
+        held = [t.pattern for _, t in triggers if parse_cidr(t.pattern) is None]
+        held += [r.pattern for _, r in rejects if parse_rule(r.pattern) is None]
+        for pattern in held:
+            self.patterns.acquire(pattern)
+
+        self.clear()
+        self.add_triggers(triggers)
+        self.add_rejects(rejects)
+
+        for pattern in held:
+            self.patterns.release(pattern)
+
+    def _sort_triggers(self) -> None:
+        # sort by action; DISABLED, IGNORE, QUIETSCAN, SCAN
+        self.triggers = OrderedDict(
+            sorted(self.triggers.items(), key=lambda a: a[1][1].action)
+        )
+
+    def add_triggers(self, triggers: Sequence[Tuple[int, Trigger]]) -> None:
+        for trigger_id, trigger in triggers:
+            # don't leak the old one's pattern if we're replacing it
+            self.remove_trigger(trigger_id)
+            if (network := parse_cidr(trigger.pattern)) is not None:
+                self.triggers[trigger_id] = (None, trigger)
+                self._cidr_triggers.add(network, trigger_id)
+            else:
+                compiled = self.patterns.acquire(trigger.pattern)
+                self.triggers[trigger_id] = (compiled, trigger)
+        self._sort_triggers()
+
+    def set_trigger(self, trigger_id: int, action: TriggerAction) -> None:
+        if trigger_id in self.triggers:
+            _, trigger = self.triggers[trigger_id]
+            trigger.action = action
+            self._sort_triggers()
+
+    def remove_trigger(self, trigger_id: int) -> None:
+        if trigger_id in self.triggers:
+            trigger_pattern, trigger = self.triggers.pop(trigger_id)
+            if trigger_pattern is None:
+                network = ip_network(trigger.pattern)
+                self._cidr_triggers.remove(network, trigger_id)
+            else:
+                self.patterns.release(trigger.pattern)
+
+    def add_rejects(self, rejects: Sequence[Tuple[int, Reject]]) -> None:
+        for reject_id, reject in rejects:
+            self.remove_reject(reject_id)
+            if (rule := parse_rule(reject.pattern)) is not None:
+                self.rejects[reject_id] = (None, reject)
+                self._version_rejects.add(rule, reject_id)
+            else:
+                compiled = self.patterns.acquire(reject.pattern)
+                self.rejects[reject_id] = (compiled, reject)
+
+    def remove_reject(self, reject_id: int) -> None:
+        if reject_id in self.rejects:
+            reject_pattern, reject = self.rejects.pop(reject_id)
+            if reject_pattern is None:
+                rule = parse_rule(reject.pattern)
+                if rule is not None:
+                    self._version_rejects.remove(rule, reject_id)
+            else:
+                self.patterns.release(reject.pattern)
+
+    def _check_cidr_triggers(self, ip: str) -> Optional[Tuple[int, TriggerAction]]:
+        try:
+            address = ip_address(ip)
+        except ValueError:
+            # not an IP (e.g. a hostname or a spoofed "0")
+            return None
+
+        # longest prefix wins, skipping any prefix whose triggers are disabled
+        for trigger_ids in self._cidr_triggers.lookup(address):
+            matches: List[Tuple[TriggerAction, int]] = []
+            for trigger_id in trigger_ids:
+                _, trigger = self.triggers[trigger_id]
+                if not trigger.action == TriggerAction.DISABLED:
+                    matches.append((trigger.action, trigger_id))
+
+            if matches:
+                trigger_action, trigger_id = min(matches)
+                return (trigger_id, trigger_action)
+        return None
+
+    def check_triggers(
+        self, nuhr: str, ip: Optional[str] = None
+    ) -> Optional[Tuple[int, TriggerAction]]:
+        matched: Optional[Tuple[int, TriggerAction]] = None
+        if ip is not None:
+            matched = self._check_cidr_triggers(ip)
+
+        for trigger_id, (trigger_pattern, trigger) in self.triggers.items():
+            if matched is not None and trigger.action >= matched[1]:
+                # sorted by action, nothing left can take precedence
+                break
+            elif (
+                trigger_pattern is None
+                or trigger.action == TriggerAction.DISABLED
+                or not trigger_pattern.search(nuhr)
+            ):
+                continue
+            return (trigger_id, trigger.action)
+        return matched
+
+    def check_rejects(self, version: str) -> Optional[int]:
+        if (reject_id := self._version_rejects.match(version)) is not None:
+            return reject_id
+
+        for reject_id, (reject_pattern, _) in self.rejects.items():
+            if reject_pattern is not None and reject_pattern.search(version):
+                return reject_id
+        else:
+            return None
@@ -0,0 +1,181 @@
+import asyncio
+import multiprocessing
+import traceback
+from itertools import count
+from multiprocessing.connection import Connection
+from typing import Any, Dict, List, Optional, Tuple
+
+from .database.trigger import TriggerAction
+from .matcher import Matcher
+
+# Matcher methods that change rules, which workers will run when told to
+UPDATES = {
+    "clear",
+    "load",
+    "add_triggers",
+    "set_trigger",
+    "remove_trigger",
+    "add_rejects",
+    "remove_reject",
+}
+CHECKS = {"check_triggers", "check_rejects"}
+
+
+def _work(conn: Connection) -> None:
+    matcher = Matcher()
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+
+        kind, *args = message
+        if kind in UPDATES:
+            getattr(matcher, kind)(*args)
+        elif kind == "batch":
+            batch_id, checks = args
+            results = [
+                getattr(matcher, check)(*check_args)
+                for check, check_args in checks
+                if check in CHECKS
+            ]
+            conn.send((batch_id, results))
+
+
+class _Worker(object):
+    def __init__(self, process: Any, conn: Connection) -> None:
+        self.process = process
+        self.conn = conn
+        self.pending: Dict[int, List["asyncio.Future[Any]"]] = {}
+
+
+class MatcherPool(object):
+    """
+    mirrors the rule set in worker processes and sends them checks in
+    batches, so matching can use more than one core. checks queue up while
+    every worker is busy and are then split between whichever are idle.
+    every update goes to every worker down the same pipe as checks, so a
+    check always sees the updates that came before it
+    """
+
+    def __init__(self, processes: int) -> None:
+        self._process_count = processes
+        self._workers: List[_Worker] = []
+        self._batch_ids = count()
+        self._batch: List[Tuple[str, Tuple[Any, ...], "asyncio.Future[Any]"]] = []
+
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    def start(self) -> None:
+        loop = asyncio.get_event_loop()
+        context = multiprocessing.get_context("spawn")
+        for _ in range(self._process_count):
+            ours, theirs = context.Pipe()
+            process = context.Process(target=_work, args=(theirs,), daemon=True)
+            process.start()
+            theirs.close()
+
+            worker = _Worker(process, ours)
+            loop.add_reader(ours.fileno(), self._read, worker)
+            self._workers.append(worker)
+
+    def stop(self) -> None:
+        loop = asyncio.get_event_loop()
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            loop.remove_reader(worker.conn.fileno())
+            worker.conn.close()
+            worker.process.join(1)
+            for futures in worker.pending.values():
+                self._fail(futures)
+
+        batch, self._batch = self._batch, []
+        self._fail([future for _, _, future in batch])
+
+    def _fail(self, futures: List["asyncio.Future[Any]"]) -> None:
+        for future in futures:
+            if not future.done():
+                future.set_exception(EOFError("matcher pool stopped"))
+
+    def _send(self, worker: _Worker, message: Tuple[Any, ...]) -> bool:
+        # this blocks the event loop until the worker has read all of
+        # `message`. workers read as fast as they can, so that's only for
+        # long with a very large rule set (e.g. "load" after connecting)
+        try:
+            worker.conn.send(message)
+        except (EOFError, OSError):
+            # a worker died. give up on the pool; callers fall back to
+            # matching in-process
+            traceback.print_exc()
+            self.stop()
+            return False
+        return True
+
+    def update(self, kind: str, *args: Any) -> None:
+        # flush queued checks first, they were asked for before this update
+        self._flush(force=True)
+        for worker in self._workers:
+            if not self._send(worker, (kind, *args)):
+                break
+
+    def _check(self, check: str, *args: Any) -> "asyncio.Future[Any]":
+        future = asyncio.get_event_loop().create_future()
+        if not self._workers:
+            future.set_exception(EOFError("matcher pool stopped"))
+            return future
+        elif not self._batch:
+            # everything asked for before we next yield goes in one batch
+            asyncio.get_event_loop().call_soon(self._flush)
+        self._batch.append((check, args, future))
+        return future
+
+    def _flush(self, force: bool = False) -> None:
+        if not self._batch or not self._workers:
+            return
+
+        workers = [worker for worker in self._workers if not worker.pending]
+        if not workers:
+            if not force:
+                # _read will flush when a worker is done with its batch
+                return
+            workers = [min(self._workers, key=lambda w: len(w.pending))]
+
+        batch, self._batch = self._batch, []
+        size = -(-len(batch) // len(workers))
+        sends: List[Tuple[_Worker, Tuple[Any, ...]]] = []
+        for worker, start in zip(workers, range(0, len(batch), size)):
+            part = batch[start : start + size]
+            batch_id = next(self._batch_ids)
+            # pending first, so stop() fails these futures if a send does
+            worker.pending[batch_id] = [future for _, _, future in part]
+            checks = [(check, args) for check, args, _ in part]
+            sends.append((worker, ("batch", batch_id, checks)))
+
+        for worker, message in sends:
+            if not self._send(worker, message):
+                break
+
+    def _read(self, worker: _Worker) -> None:
+        try:
+            batch_id, results = worker.conn.recv()
+        except (EOFError, OSError):
+            # as in _send
+            traceback.print_exc()
+            self.stop()
+            return
+
+        for future, result in zip(worker.pending.pop(batch_id), results):
+            if not future.done():
+                future.set_result(result)
+        # this worker's free now, give it whatever's queued up
+        self._flush()
+
+    async def check_triggers(
+        self, nuhr: str, ip: Optional[str]
+    ) -> Optional[Tuple[int, TriggerAction]]:
+        return await self._check("check_triggers", nuhr, ip)
+
+    async def check_rejects(self, version: str) -> Optional[int]:
+        return await self._check("check_rejects", version)
@@ -0,0 +1,144 @@
+import asyncio
+import traceback
+from collections import deque
+from dataclasses import dataclass
+from enum import Enum
+from typing import Awaitable, Callable, Deque, List, Optional, Tuple
+
+from irctokens import Line
+
+from .database.trigger import TriggerAction
+
+RPL_ENDOFTRACE = "262"
+RPL_ETRACE = "709"
+
+# how many users to match before letting other coroutines run
+MATCH_CHUNK = 100
+
+CheckFunc = Callable[[str, str], Awaitable[Optional[Tuple[int, TriggerAction]]]]
+# nick, nuhr, trigger ID, trigger action
+TriggeredFunc = Callable[[str, str, int, TriggerAction], Awaitable[None]]
+
+
+class SweepState(Enum):
+    ENUMERATING = 1
+    RUNNING = 2
+    PAUSED = 3
+    DONE = 4
+    CANCELLED = 5
+    FAILED = 6
+
+
+@dataclass
+class SweepUser:
+    nick: str
+    nuhr: str
+    ip: str
+
+
+def parse_etrace(line: Line) -> Optional[SweepUser]:
+    # :server 709 me User class nick user host ip :realname
+    if not line.command == RPL_ETRACE or len(line.params) < 8:
+        return None
+
+    _, _, _, nick, user, host, ip, real = line.params[:8]
+    return SweepUser(nick, f"{nick}!{user}@{host} {real}", ip)
+
+
+class Sweep(object):
+    """
+    retroactively match already-connected users against triggers, then
+    handle those that match as though they'd just connected, no faster than
+    `rate` per second
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        check: CheckFunc,
+        triggered: TriggeredFunc,
+        log: Callable[[str], Awaitable[None]],
+    ) -> None:
+        self.state = SweepState.ENUMERATING
+        self.users: List[SweepUser] = []
+        self.checked = 0
+        self.sent = 0
+
+        self._rate = rate
+        self._check = check
+        self._triggered = triggered
+        self._log = log
+
+        self._pending: Deque[Tuple[SweepUser, int, TriggerAction]] = deque()
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    @property
+    def active(self) -> bool:
+        return self.state in {
+            SweepState.ENUMERATING,
+            SweepState.RUNNING,
+            SweepState.PAUSED,
+        }
+
+    def add_user(self, user: SweepUser) -> None:
+        self.users.append(user)
+
+    def start(self) -> None:
+        self.state = SweepState.RUNNING
+        self._task = asyncio.create_task(self._run())
+
+    def pause(self) -> None:
+        self.state = SweepState.PAUSED
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def cancel(self) -> None:
+        self.pause()
+        self.state = SweepState.CANCELLED
+        self._pending.clear()
+
+    def status(self) -> str:
+        return (
+            f"{self.state.name}: checked {self.checked}/{len(self.users)} users,"
+            f" sent {self.sent}/{self.sent + len(self._pending)} CTCP VERSIONs"
+        )
+
+    async def _run(self) -> None:
+        try:
+            await self._sweep()
+        except Exception as e:
+            traceback.print_exc()
+            self.state = SweepState.FAILED
+            self._task = None
+            await self._log(f"SWEEP: {self.status()} ({type(e).__name__}: {e})")
+
+    async def _sweep(self) -> None:
+        # picks up where it left off if we were paused
+        while self.checked < len(self.users):
+            users = self.users[self.checked : self.checked + MATCH_CHUNK]
+            # all at once, so a matching pool gets them as one batch
+            matches = await asyncio.gather(
+                *(self._check(user.nuhr, user.ip) for user in users)
+            )
+            for user, matched in zip(users, matches):
+                if matched is not None and matched[1] in {
+                    TriggerAction.SCAN,
+                    TriggerAction.QUIETSCAN,
+                }:
+                    trigger_id, trigger_action = matched
+                    self._pending.append((user, trigger_id, trigger_action))
+            self.checked += len(users)
+            # let live cliconn lines through
+            await asyncio.sleep(0)
+
+        while self._pending:
+            user, trigger_id, trigger_action = self._pending[0]
+            await self._triggered(user.nick, user.nuhr, trigger_id, trigger_action)
+            self._pending.popleft()
+            self.sent += 1
+            await asyncio.sleep(1 / self._rate)
+
+        self.state = SweepState.DONE
+        self._task = None
+        await self._log(f"SWEEP: {self.status()}")
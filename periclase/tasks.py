@@ -0,0 +1,76 @@
+import asyncio
+import traceback
+from typing import Any, Awaitable, Callable, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+_Job = Tuple[Callable[[], Awaitable[Any]], "asyncio.Future[Any]"]
+
+
+class TaskQueue(object):
+    """
+    runs queued coroutine functions on a fixed number of worker tasks. with
+    one worker, jobs run strictly in the order they were queued. workers that
+    die are restarted.
+    """
+
+    def __init__(
+        self, workers: int, timeout: Optional[float] = None, maxsize: int = 0
+    ) -> None:
+        self._worker_count = workers
+        self._timeout = timeout
+        self._queue: "asyncio.Queue[_Job]" = asyncio.Queue(maxsize)
+        self._workers: List["asyncio.Task[None]"] = []
+
+    def start(self) -> None:
+        while len(self._workers) < self._worker_count:
+            self._spawn()
+
+    def stop(self) -> None:
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.cancel()
+
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            future.cancel()
+
+    def _spawn(self) -> None:
+        worker = asyncio.create_task(self._work())
+        worker.add_done_callback(self._worker_done)
+        self._workers.append(worker)
+
+    def _worker_done(self, worker: "asyncio.Task[None]") -> None:
+        if worker in self._workers:
+            # we didn't stop() this worker, so it died. replace it
+            self._workers.remove(worker)
+            if not worker.cancelled() and (e := worker.exception()) is not None:
+                traceback.print_exception(type(e), e, e.__traceback__)
+            self._spawn()
+
+    def put(self, func: Callable[[], Awaitable[T]]) -> "asyncio.Future[T]":
+        # raises asyncio.QueueFull if we were given a maxsize and we're full
+        future: "asyncio.Future[T]" = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((func, future))
+        return future
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    async def _work(self) -> None:
+        while True:
+            func, future = await self._queue.get()
+            if future.done():
+                # cancelled while it was queued
+                continue
+
+            try:
+                if self._timeout is None:
+                    result = await func()
+                else:
+                    result = await asyncio.wait_for(func(), self._timeout)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
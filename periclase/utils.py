@@ -1,50 +1,113 @@
 import re
-from typing import Pattern, Tuple
+from dataclasses import dataclass
+from functools import lru_cache
+from ipaddress import ip_network
+from typing import Dict, Optional, Pattern, Tuple
 
+from .cidr import IPNetwork
 
-def _find_unescaped(s: str, c: int) -> int:
-    i = 1
-    while i < len(s):
-        c2 = ord(s[i])
-        i += 1
-        if c2 == ord("\\"):
-            i += 1
-        elif c2 == c:
-            return i
-    else:
-        return -1
+# `/regex/flags remaining`, in one pass; a backslash escapes whatever follows
+RE_PATTERN = re.compile(
+    r"^(?P<delim>.)(?P<regex>(?:\\.|(?!(?P=delim))[^\\])*)(?P=delim)"
+    r"(?P<flags>[^ ]*)(?: (?P<remaining>.*))?$",
+    re.DOTALL,
+)
+# flags in the order we apply them
+PATTERN_FLAGS = "i^$"
 
 
-def lex_pattern(pattern: str) -> Tuple[int, str, str, str]:
-    pattern_delim_ = pattern[0]
-    if pattern_delim_.isalnum():
-        raise ValueError("pattern delimiter cannot be alphanumeric")
-    pattern_delim = ord(pattern_delim_)
+@dataclass(frozen=True)
+class PatternToken:
+    # `delim` + `regex` + `delim` + `flags`, with flags deduplicated and sorted
+    canonical: str
+    # what we actually hand to re.compile()
+    key: Tuple[str, int]
+
 
-    regex_end = _find_unescaped(pattern, pattern_delim)
-    if regex_end == -1:
+def tokenize_pattern(pattern: str) -> Tuple[PatternToken, str]:
+    if pattern[0].isalnum():
+        raise ValueError("pattern delimiter cannot be alphanumeric")
+    elif (p_pattern := RE_PATTERN.search(pattern)) is None:
         raise ValueError("unterminated regex")
 
-    regex, pattern_flags = pattern[1 : regex_end - 1], pattern[regex_end:]
-    pattern_flags, _, remaining = pattern_flags.partition(" ")
-    return (pattern_delim, regex, pattern_flags, remaining)
+    delim, regex, flags, remaining = p_pattern.group(
+        "delim", "regex", "flags", "remaining"
+    )
+    for flag in flags:
+        if not flag in PATTERN_FLAGS:
+            raise ValueError(f"unknown pattern flag '{flag}'")
+    flags = "".join(f for f in PATTERN_FLAGS if f in flags)
+
+    canonical = f"{delim}{regex}{delim}{flags}"
+    if delim in {"'", '"'}:
+        regex = re.escape(regex)
+
+    regex_flags = 0
+    if "i" in flags:
+        regex_flags |= re.I
+    if "^" in flags:
+        regex = f"^{regex}"
+    if "$" in flags:
+        regex = f"{regex}$"
+
+    return (PatternToken(canonical, (regex, regex_flags)), remaining or "")
+
+
+def _compile(key: Tuple[str, int]) -> Pattern:
+    try:
+        return re.compile(*key)
+    except re.error as e:
+        # so it's reported like any other bad pattern
+        raise ValueError(f"invalid regex: {e}")
 
 
 def compile_pattern(pattern: str) -> Pattern:
-    pattern_delim, regex, pattern_flags, _2 = lex_pattern(pattern)
+    token, _ = tokenize_pattern(pattern)
+    return _compile(token.key)
 
-    if pattern_delim in {ord("'"), ord('"')}:
-        regex = re.escape(regex)
 
-    regex_flags = 0
-    for pattern_flag in pattern_flags:
-        if pattern_flag == "i":
-            regex_flags |= re.I
-        elif pattern_flag == "^":
-            regex = f"^{regex}"
-        elif pattern_flag == "$":
-            regex = f"{regex}$"
+@lru_cache(maxsize=4096)
+def _pattern_key(pattern: str) -> Tuple[str, int]:
+    # stored patterns are acquired and released over and over; don't re-lex them
+    token, _ = tokenize_pattern(pattern)
+    return token.key
+
+
+class PatternCache(object):
+    """
+    compiled patterns shared between every rule that uses them, whatever
+    delimiter or flag order they were written with. freed when the last rule
+    using them is released
+    """
+
+    def __init__(self) -> None:
+        self._patterns: Dict[Tuple[str, int], Tuple[Pattern, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._patterns)
+
+    def acquire(self, pattern: str) -> Pattern:
+        key = _pattern_key(pattern)
+        if key in self._patterns:
+            compiled, refs = self._patterns[key]
         else:
-            raise ValueError(f"unknown pattern flag '{pattern_flag}'")
+            compiled, refs = _compile(key), 0
+        self._patterns[key] = (compiled, refs + 1)
+        return compiled
+
+    def release(self, pattern: str) -> None:
+        key = _pattern_key(pattern)
+        if key in self._patterns:
+            compiled, refs = self._patterns[key]
+            if refs > 1:
+                self._patterns[key] = (compiled, refs - 1)
+            else:
+                del self._patterns[key]
+
 
-    return re.compile(regex, regex_flags)
+def parse_cidr(pattern: str) -> Optional[IPNetwork]:
+    # a stored trigger pattern is either a `/regex/` or a canonical CIDR
+    try:
+        return ip_network(pattern)
+    except ValueError:
+        return None
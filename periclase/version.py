@@ -0,0 +1,110 @@
+import operator
+from dataclasses import dataclass
+from re import compile as re_compile
+from typing import Callable, Dict, List, Optional, Tuple
+
+# (numbers, 1 for a release or 0 for a pre-release, pre-release tag rank,
+#  pre-release number), so that 0.33.3-rc1 < 0.33.3
+VersionTuple = Tuple[Tuple[int, ...], int, int, int]
+
+PRE_RELEASES = {"dev": 0, "a": 1, "alpha": 1, "b": 2, "beta": 2, "pre": 3, "rc": 4}
+# a pre-release tag can't have letters straight after it, so that e.g.
+# `3.8-amd64` and `3.8-bookworm` are 3.8 with some suffix, not pre-releases
+RE_NUMBER = re_compile(
+    r"^v?(?P<number>\d+(?:\.\d+)*)"
+    r"(?:[-.~_]?(?P<pre>alpha|beta|dev|pre|rc|a|b)(?![A-Za-z])"
+    r"\.?(?P<pre_number>\d*)(?![A-Za-z0-9]))?"
+)
+# e.g. `matrix-appservice-irc < 0.33.3`. starts with an alphanumeric, so it
+# can never be mistaken for a `/regex/`
+RE_RULE = re_compile(
+    r"^(?P<product>[A-Za-z0-9]\S*) (?P<op><=|>=|==|!=|<|>|=) (?P<version>\S+)$"
+)
+
+OPERATORS: Dict[str, Callable[[VersionTuple, VersionTuple], bool]] = {
+    "<": operator.lt,
+    "<=": operator.le,
+    "=": operator.eq,
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">=": operator.ge,
+    ">": operator.gt,
+}
+
+
+def _number(s: str, full: bool = False) -> Optional[VersionTuple]:
+    # `full` for versions we're given in rules, which must be nothing but a
+    # version. CTCP VERSION replies can have other things stuck on the end
+    p_number = RE_NUMBER.fullmatch(s) if full else RE_NUMBER.search(s)
+    if p_number is None:
+        return None
+
+    number = [int(n) for n in p_number.group("number").split(".")]
+    # so that 0.33 and 0.33.0 compare equal
+    while len(number) > 1 and number[-1] == 0:
+        number.pop()
+
+    if (pre := p_number.group("pre")) is None:
+        return (tuple(number), 1, 0, 0)
+    pre_number = int(p_number.group("pre_number") or "0")
+    return (tuple(number), 0, PRE_RELEASES[pre], pre_number)
+
+
+def parse_version(version: str) -> Optional[Tuple[str, VersionTuple]]:
+    # `matrix-appservice-irc 0.33.1 bridged via matrix.org`
+    # -> ("matrix-appservice-irc", ((0, 33, 1), 1, 0, 0))
+    product, _, rest = version.partition(" ")
+    number_s, _, _ = rest.partition(" ")
+    if product == "" or (number := _number(number_s)) is None:
+        return None
+    return (product.lower(), number)
+
+
+@dataclass
+class VersionRule:
+    product: str
+    op: str
+    version: VersionTuple
+
+    def match(self, version: VersionTuple) -> bool:
+        return OPERATORS[self.op](version, self.version)
+
+
+def parse_rule(pattern: str) -> Optional[VersionRule]:
+    # a stored reject pattern is either a `/regex/` or a version rule
+    if (p_rule := RE_RULE.search(pattern)) is None:
+        return None
+    elif (version := _number(p_rule.group("version"), full=True)) is None:
+        return None
+    return VersionRule(p_rule.group("product").lower(), p_rule.group("op"), version)
+
+
+class VersionIndex(object):
+    """
+    version rules keyed by product, so checking a CTCP VERSION reply is one
+    dict lookup plus comparing against that product's (few) rules
+    """
+
+    def __init__(self) -> None:
+        self._products: Dict[str, List[Tuple[int, VersionRule]]] = {}
+
+    def add(self, rule: VersionRule, value: int) -> None:
+        rules = self._products.setdefault(rule.product, [])
+        rules.append((value, rule))
+        rules.sort(key=lambda r: r[0])
+
+    def remove(self, rule: VersionRule, value: int) -> None:
+        rules = self._products.get(rule.product, [])
+        rules[:] = [r for r in rules if not r[0] == value]
+        if not rules:
+            self._products.pop(rule.product, None)
+
+    def match(self, version: str) -> Optional[int]:
+        if (parsed := parse_version(version)) is None:
+            return None
+
+        product, number = parsed
+        for value, rule in self._products.get(product, []):
+            if rule.match(number):
+                return value
+        return None